@@ -0,0 +1,219 @@
+# Tests for parsing WikiMedia dump files
+#
+# Copyright (c) 2022 Tatu Ylonen.  See file LICENSE and https://ylonen.org
+
+import io
+import os
+import gzip
+import shutil
+import tempfile
+import warnings
+import unittest
+import tracemalloc
+import xml.etree.ElementTree as ET
+from unittest import mock
+from wikitextprocessor.dumpparser import (make_iter, process_input,
+                                          ThreadedReader)
+
+
+DUMP = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" version="0.10" xml:lang="en">
+  <siteinfo>
+    <sitename>Wiktionary</sitename>
+    <namespaces>
+      <namespace key="0" case="case-sensitive" />
+      <namespace key="10" case="case-sensitive">Template</namespace>
+    </namespaces>
+  </siteinfo>
+  <page>
+    <title>foo</title>
+    <ns>0</ns>
+    <id>1</id>
+    <revision>
+      <id>11</id>
+      <contributor>
+        <username>Someone</username>
+        <id>2</id>
+      </contributor>
+      <model>wikitext</model>
+      <format>text/x-wiki</format>
+      <text bytes="20" xml:space="preserve">==English==
+a &lt;b&gt; &amp;amp;</text>
+    </revision>
+  </page>
+  <page>
+    <title>Foo</title>
+    <ns>0</ns>
+    <id>3</id>
+    <redirect title="foo" />
+    <revision>
+      <id>12</id>
+      <model>wikitext</model>
+      <format>text/x-wiki</format>
+      <text bytes="14" xml:space="preserve">#REDIRECT [[foo]]</text>
+    </revision>
+  </page>
+  <page>
+    <title>Template:empty</title>
+    <ns>10</ns>
+    <id>4</id>
+    <revision>
+      <id>13</id>
+      <model>wikitext</model>
+      <format>text/x-wiki</format>
+      <text bytes="0" xml:space="preserve" />
+    </revision>
+  </page>
+</mediawiki>
+"""
+
+EXPECTED = [("wikitext", "foo", "==English==\na <b> &amp;"),
+            ("redirect", "Foo", "foo"),
+            ("wikitext", "Template:empty", "")]
+
+
+def page_cb(model, title, text):
+    return model, title, text
+
+
+class DumpParserTests(unittest.TestCase):
+
+    def test_make_iter(self):
+        f = io.BytesIO(DUMP.encode("utf-8"))
+        self.assertEqual(list(make_iter(f)), EXPECTED)
+
+    def test_make_iter_other_version(self):
+        dump = DUMP.replace("export-0.10/", "export-0.11/")
+        f = io.BytesIO(dump.encode("utf-8"))
+        self.assertEqual(list(make_iter(f)), EXPECTED)
+
+    def test_threaded_reader(self):
+        data = DUMP.encode("utf-8")
+        f = ThreadedReader(io.BytesIO(data), block_size=100, max_blocks=2)
+        self.assertEqual(list(make_iter(f)), EXPECTED)
+        self.assertEqual(f.read(), b"")
+        f.close()
+
+        class FailingFile(object):
+            def read(self, size):
+                raise OSError("read failed")
+
+            def close(self):
+                pass
+
+        f = ThreadedReader(FailingFile())
+        for i in range(2):
+            with self.assertRaises(OSError):
+                f.read(10)
+        f.close()
+
+    def test_threaded_reader_close(self):
+        data = DUMP.encode("utf-8")
+        f = ThreadedReader(io.BytesIO(data), block_size=10, max_blocks=2)
+        self.assertEqual(f.read(5), data[:5])
+        self.assertEqual(f.read(), data[5:10])
+        f.close()
+        self.assertFalse(f.thread.is_alive())
+
+    def test_process_input(self):
+        path = "tests/test-pages-articles.xml.bz2"
+        titles = set()
+        redirects = 0
+
+        def page_cb(model, title, text):
+            nonlocal redirects
+            titles.add(title)
+            if model == "redirect":
+                redirects += 1
+            return title
+
+        ret = process_input(path, page_cb)
+        self.assertEqual(len(ret), len(titles))
+        self.assertGreater(len(titles), 100)
+        self.assertGreater(redirects, 0)
+
+    def test_process_input_memory(self):
+        # Memory use should be bounded by the largest page and the read
+        # buffers, not grow with the size of the dump.  The test dump is
+        # about 9.5 MB uncompressed, and keeping its whole tree in memory
+        # would take about 30 MB.
+        path = "tests/test-pages-articles.xml.bz2"
+        tracemalloc.start()
+        try:
+            process_input(path, lambda *page: None)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 16 * 1024 * 1024)
+
+    def test_process_input_parallel(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "dump.xml")
+            with open(path, "w") as f:
+                f.write(DUMP)
+            ret = process_input(path, page_cb, num_threads=2)
+            self.assertEqual(sorted(ret), sorted(EXPECTED))
+
+    def test_process_input_parallel_threaded(self):
+        # Without decompressor programs the input is read by ThreadedReader.
+        # The page is large enough to keep its thread busy, and the
+        # processes must be forked before the thread is started.
+        dump = DUMP.replace("==English==", "x" * (16 * 1024 * 1024))
+        expected = [(model, title, text.replace("==English==",
+                                                "x" * (16 * 1024 * 1024)))
+                    for model, title, text in EXPECTED]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "dump.xml.gz")
+            with gzip.open(path, "wb") as f:
+                f.write(dump.encode("utf-8"))
+            with mock.patch("shutil.which", return_value=None), \
+                 warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                ret = process_input(path, page_cb, num_threads=2)
+            self.assertEqual(sorted(ret), sorted(expected))
+            self.assertFalse([w for w in caught
+                              if "fork()" in str(w.message)])
+
+    def test_process_input_formats(self):
+        data = DUMP.encode("utf-8")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "dump.xml")
+            with open(path, "wb") as f:
+                f.write(data)
+            with gzip.open(path + ".gz", "wb") as f:
+                f.write(data)
+            for p in (path, path + ".gz"):
+                ret = process_input(p, lambda *page: page)
+                self.assertEqual(ret, EXPECTED)
+
+    def test_process_input_missing(self):
+        for path in ("tests/nonexistent.xml", "tests/nonexistent.xml.bz2"):
+            with self.assertRaises(FileNotFoundError):
+                process_input(path, page_cb)
+
+    @unittest.skipUnless(shutil.which("pigz") or shutil.which("gzip"),
+                         "needs an external gzip decompressor")
+    def test_process_input_corrupt(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "dump.xml.gz")
+            with open(path, "wb") as f:
+                f.write(gzip.compress(DUMP.encode("utf-8"))[:200])
+            with self.assertRaises(RuntimeError) as cm:
+                process_input(path, page_cb)
+            self.assertIn(path, str(cm.exception))
+
+    @unittest.skipUnless(shutil.which("pigz") or shutil.which("gzip"),
+                         "needs an external gzip decompressor")
+    def test_process_input_xml_error(self):
+        # The decompressor is still writing when the parser fails; the
+        # error must be reported as an XML error, not a decompressor error.
+        start = DUMP.index("  <page>")
+        end = DUMP.index("</mediawiki>")
+        page = DUMP[start:DUMP.index("  <page>", start + 1)]
+        bad = page.replace("</title>", "</titel>")
+        dump = DUMP[:start] + bad + page * 20000 + DUMP[end:]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "dump.xml.gz")
+            with gzip.open(path, "wb") as f:
+                f.write(dump.encode("utf-8"))
+            with self.assertRaises(ET.ParseError):
+                process_input(path, page_cb)
@@ -3199,6 +3199,51 @@ return export
         except FileNotFoundError:
             pass
 
+    def add_pages_buffered(self, ctx):
+        """Adds pages to ``ctx`` so that the page buffer is flushed, a page
+        is written directly, and a page exactly fills the buffer.  Returns
+        a dict of the page contents."""
+        pages = {}
+
+        def add(title, text):
+            ctx.add_page("wikitext", title, text)
+            pages[title] = text
+
+        for i in range(2000):
+            add("Small{}".format(i), "päge {}\n".format(i).ljust(1000, "x"))
+        # At least buf_size, so this is written directly to the file
+        add("Big", "b" * (5 * 1024 * 1024))
+        self.assertGreaterEqual(len(pages["Big"]), ctx.buf_size)
+        for i in range(2000, 7000):
+            add("Small{}".format(i), "päge {}\n".format(i).ljust(1000, "y"))
+        # Fill the buffer exactly; the next page flushes it
+        size = ctx.buf_size - ctx.buf_ofs
+        self.assertTrue(0 < size < ctx.buf_size)
+        add("Fill", "f" * size)
+        self.assertEqual(ctx.buf_ofs, ctx.buf_size)
+        for i in range(7000, 7100):
+            add("Small{}".format(i), "page {}".format(i))
+        return pages
+
+    def test_add_page_buffered1(self):
+        # Read pages back before analyze_templates()
+        ctx = Wtp(quiet=True)
+        pages = self.add_pages_buffered(ctx)
+        for title, text in pages.items():
+            self.assertEqual(ctx.read_by_title(title), text)
+        ctx.analyze_templates()
+        for title, text in pages.items():
+            self.assertEqual(ctx.read_by_title(title), text)
+
+    def test_add_page_buffered2(self):
+        # Read pages back only after analyze_templates()
+        ctx = Wtp(quiet=True)
+        pages = self.add_pages_buffered(ctx)
+        ctx.analyze_templates()
+        self.assertEqual(ctx.buf_ofs, 0)
+        for title, text in pages.items():
+            self.assertEqual(ctx.read_by_title(title), text)
+
     def test_lua_max_time1(self):
         t = time.time()
         self.scribunto('<strong class="error">Lua timeout error in '
@@ -193,6 +193,8 @@ class Wtp(object):
         self.templates = {}
         self.need_pre_expand = None
         self.cache_file_old = False
+        self.buf_ofs = 0
+        self.tmp_ofs = 0
         # Add predefined templates
         self.templates["!"] = "|"
         self.templates["!-"] = "|-"
@@ -557,18 +559,18 @@ class Wtp(object):
         if self.need_pre_expand is not None:
             self._reset_pages()
 
-        # Save the page in our temporary file and metadata in memory
+        # Save the page in our temporary file and metadata in memory.  Pages
+        # are collected in self.buf and written in large blocks.
         rawtext = text.encode("utf-8")
         if self.buf_ofs + len(rawtext) > self.buf_size:
-            bufview = memoryview(self.buf)[0: self.buf_ofs]
-            self.tmp_file.write(bufview)
-            self.buf_ofs = 0
+            self._flush_buf()
         ofs = self.tmp_ofs
         self.tmp_ofs += len(rawtext)
-        if len(rawtext) >= self.buf_ofs:
+        if len(rawtext) >= self.buf_size:
             self.tmp_file.write(rawtext)
         else:
             self.buf[self.buf_ofs: self.buf_ofs + len(rawtext)] = rawtext
+            self.buf_ofs += len(rawtext)
         # XXX should we canonicalize title in page_contents
         self.page_contents[title] = (title, model, ofs, len(rawtext))
         self.page_seq.append((model, title))
@@ -593,6 +595,14 @@ class Wtp(object):
         assert isinstance(body, str)
         self.templates[name] = body
 
+    def _flush_buf(self):
+        """Writes any page contents collected in self.buf by add_page() to
+        the temporary file."""
+        if self.buf_ofs > 0:
+            bufview = memoryview(self.buf)[0: self.buf_ofs]
+            self.tmp_file.write(bufview)
+            self.buf_ofs = 0
+
     def _analyze_template(self, name, body):
         """Analyzes a template body and returns a set of the canonicalized
         names of all other templates it calls and a boolean that is True
@@ -704,6 +714,9 @@ class Wtp(object):
         essential to parsing Wikitext syntax, such as table start or end
         tags.  Such templates generally need to be expanded before
         parsing the page."""
+        # All pages have now been collected; make them readable from the
+        # temporary file (also by parallel processes in reprocess())
+        self._flush_buf()
         self.need_pre_expand = set()
         included_map = collections.defaultdict(set)
         expand_q = []
@@ -1352,6 +1365,7 @@ class Wtp(object):
         FOR THIS TO DO SOMETHING."""
         assert callable(page_handler)
         assert autoload in (True, False)
+        self._flush_buf()
         global _global_ctx
         global _global_page_handler
         global _global_page_autoload
@@ -1445,6 +1459,7 @@ class Wtp(object):
             return None
         # The page seems to exist
         title, model, ofs, page_size = self.page_contents[title]
+        self._flush_buf()
         # Use os.pread() so that we won't change the file offset; otherwise we
         # might cause a race condition with parallel scanning of the temporary
         # file.
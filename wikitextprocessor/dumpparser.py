@@ -5,203 +5,318 @@
 import re
 import sys
 import bz2
-import json
-import html
-import traceback
+import errno
+import gzip
+import os
+import queue
+import shutil
+import multiprocessing
+import threading
 import subprocess
+import xml.etree.ElementTree as ET
 
-# These XML tags are ignored when parsing.
-ignore_xml_tags = set(["sha1", "comment", "username", "timestamp",
-                       "sitename", "dbname", "base", "generator", "case",
-                       "ns", "restrictions", "contributor", "username",
-                       "minor", "parentid", "namespaces", "revision",
-                       "siteinfo", "mediawiki",
-                       "id", "revision", "namespace", "format",
-                       # "model",
-])
+# Parallel bzip2 decompression in this process, if installed.
+try:
+    import indexed_bzip2
+except ImportError:
+    indexed_bzip2 = None
 
-# Other tags are ignored inside these tags.
-xml_stack_ignore = ("contributor",)
+# Faster gzip decompression using the ISA-L library, if installed.
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
 
 
-class DumpParser(object):
-    """This class is used for XML parsing the MediaWiki dump file."""
+def open_indexed_bzip2(path):
+    """Opens a bzip2 file for decompressing it using all available cores."""
+    return indexed_bzip2.open(path, parallelization=os.cpu_count())
+
+
+# Methods for decompressing dump files, in order of preference.  Tuples are
+# commands for running an external program and functions open the file for
+# decompressing in this process.  Methods that are not available are None.
+decompressors = {
+    ".bz2": (("lbzip2", "-dc"),
+             ("pbzip2", "-dc"),
+             open_indexed_bzip2 if indexed_bzip2 is not None else None,
+             ("bzip2", "-dc"),
+             bz2.open),
+    ".gz": (("pigz", "-dc"),
+            igzip.open if igzip is not None else None,
+            ("gzip", "-dc"),
+            gzip.open),
+}
+
+# Size of the buffer used for reading (possibly decompressed) dump files.
+read_buffer_size = 1024 * 1024
+
+
+class ThreadedReader(object):
+    """File-like object that reads the binary file ``f`` in a background
+    thread, in blocks of ``block_size`` bytes, keeping at most
+    ``max_blocks`` blocks read ahead.  This is used for decompressing dump
+    files in this process while they are being parsed; the decompressor
+    modules release the GIL while decompressing.  Only ``read()`` and
+    ``close()`` are supported."""
 
     __slots__ = (
-        "tag",
-        "stack",
-        "stack_ignore",
-        "text",
-        "title",
-        "redirect",
-        "model",
-        "aborted",
-        "data",
-        "args",
+        "f",
+        "queue",
+        "thread",
         "buf",
         "ofs",
+        "closed",
+        "error",
     )
 
-    def __init__(self):
-        self.tag = None
-        self.stack = []
-        self.stack_ignore = False
-        self.text = None
-        self.title = None
-        self.redirect = None
-        self.model = None
-        self.aborted = False
-        self.data = []
-        self.args = b""
-
-tag_re = re.compile(
-    rb"""(?s)<!--[^\0]*?-->|"""
-    rb"""<([^>\s]+)"""
-    rb"""(\s+[^"'>/=\s]+\b(\s*=\s*("[^"]*"|'[^']*'|[^ \t\n"'`=<>]*))?)*?"""
-    rb"""\s*(/\s*)?>""")
-
-arg_re = re.compile(
-    rb"""([^"'>/=\s]+)(\s*=\s*("[^"]*"|'[^']*'|[^ \t\n"'`=<>]*))?"""
-)
-
-def make_iter(f):
-    dp = DumpParser()
-    dp.buf = b""
-    dp.ofs = 0
-
-    def handle_start(tag, args):
-        """This is called whenever an XML start tag is encountered."""
-        assert isinstance(tag, str)
-        assert isinstance(args, bytes)
-        dp.args = args
-        dp.tag = tag
-        dp.stack.append(tag)
-        dp.data = []
-        if tag == "page":
-            dp.text = None
-            dp.title = None
-            dp.redirect = None
-            dp.model = None
-        elif tag in xml_stack_ignore:
-            dp.stack_ignore = True
-
-    def parse_attrs(args):
-        attrs = {}
-        for m in re.finditer(arg_re, args):
-            name = m.group(1).decode("utf-8")
-            if m.group(2):
-                value = m.group(3).decode("utf-8")
-            else:
-                value = ""
-            if value.startswith("'") or value.startswith('"'):
-                value = value[1:-1]
-            attrs[name] = value
-        return attrs
-
-    def handle_end(tag):
-        """This function is called whenever an XML end tag is encountered."""
-        ptag = dp.stack.pop()
-        if ptag in xml_stack_ignore:
-            dp.stack_ignore = False
-        if tag in ignore_xml_tags or dp.stack_ignore:
-            return None
-
-        data = b"".join(dp.data)
-        data = data.decode("utf-8")
-        dp.data = []
-
-        if tag == "title":
-            dp.title = data
-        elif tag == "text":
-            dp.text = data
-        elif tag == "redirect":
-            attrs = parse_attrs(dp.args)
-            dp.redirect = attrs.get("title")
-        elif tag == "page":
-            if dp.redirect:
-                return "redirect", dp.title, dp.redirect
-            return dp.model, dp.title, dp.text
-        elif tag == "model":
-            dp.model = data
-        else:
-            attrs = parse_attrs(dp.args)
-            print("UNSUPPORTED", tag, len(data), attrs)
-        return None
+    def __init__(self, f, block_size=read_buffer_size, max_blocks=8):
+        self.f = f
+        self.queue = queue.Queue(maxsize=max_blocks)
+        self.buf = b""
+        self.ofs = 0
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self.reader,
+                                       args=(block_size,), daemon=True)
+        self.thread.start()
 
-    def article_iter():
+    def reader(self, block_size):
+        """Reads ``f`` until end of file or until closed.  This runs in the
+        background thread.  An empty block marks end of file; exceptions
+        are passed to the reading side."""
         try:
-            while not dp.aborted:
-                more_data = f.read(64 * 1024)
-                if not more_data:
-                    rest = dp.buf[dp.ofs:]
-                    dp.data.append(rest)
+            while not self.closed:
+                data = self.f.read(block_size)
+                self.queue.put(data)
+                if not data:
                     break
-                dp.buf = dp.buf[dp.ofs:] + more_data
-                dp.ofs = 0
-                for m in re.finditer(tag_re, dp.buf):
-                    before = dp.buf[dp.ofs:m.start()]
-                    if before:
-                        dp.data.append(before)
-                    dp.ofs = m.end()
-                    tag = m.group(1)
-                    if not tag:
-                        continue
-                    tag = tag.lower().decode("utf-8")
-                    args = m.group(2) or b""
-                    close = m.group(5)
-                    if tag.startswith("/"):
-                        tag = tag[1:]
-                        art = handle_end(tag)
-                        if art:
-                            yield art
-                    elif close:
-                        handle_start(tag, args)
-                        art = handle_end(tag)
-                        if art:
-                            yield art
-                    else:
-                        handle_start(tag, args)
         except Exception as e:
-            print("GOT EXCEPTION", str(e))
-            traceback.print_exc()
-            raise
+            self.queue.put(e)
+
+    def read(self, size=-1):
+        """Returns up to ``size`` bytes (or the rest of the current block if
+        ``size`` is negative) or b"" at end of file.  If reading ``f``
+        failed, this raises the same exception on every call."""
+        if self.error is not None:
+            raise self.error
+        if self.buf is None:
+            return b""
+        if self.ofs >= len(self.buf):
+            data = self.queue.get()
+            if isinstance(data, Exception):
+                # The thread has exited; don't wait for more data later
+                self.error = data
+                raise data
+            if not data:
+                self.buf = None
+                return b""
+            self.buf = data
+            self.ofs = 0
+        if size < 0 or self.ofs + size > len(self.buf):
+            size = len(self.buf) - self.ofs
+        data = self.buf[self.ofs:self.ofs + size]
+        self.ofs += size
+        return data
+
+    def close(self):
+        """Stops the background thread and closes ``f``."""
+        self.closed = True
+        # Make room in the queue in case the thread is blocked on it
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.f.close()
+
+
+def make_iter(f):
+    """Returns an iterator over the pages in the MediaWiki XML dump read
+    from the file-like object ``f``.  The iterator yields a tuple
+    (model, title, text) for each page.  For redirects, ``model`` is
+    "redirect" and ``text`` is the title of the page redirected to."""
+
+    def article_iter():
+        context = ET.iterparse(f, events=("start", "end"))
+        ev, root = next(context)
+        # Tags are qualified by the XML namespace of the export format,
+        # the version of which varies between dumps.
+        m = re.match(r"\{[^}]*\}", root.tag)
+        xmlns = m.group(0) if m else ""
+        page_tag = xmlns + "page"
+        title_tag = xmlns + "title"
+        redirect_tag = xmlns + "redirect"
+        revision_tag = xmlns + "revision"
+        model_tag = xmlns + "model"
+        text_tag = xmlns + "text"
+        intern = sys.intern
+        for ev, elem in context:
+            if ev != "end" or elem.tag != page_tag:
+                continue
+            # Collect the fields of the page in a single pass over its
+            # children rather than searching separately for each.
+            title = redirect = model = text = None
+            for child in elem:
+                tag = child.tag
+                if tag == title_tag:
+                    title = child.text or ""
+                elif tag == redirect_tag:
+                    redirect = child.get("title")
+                    # The text and model of redirects are not used.  The
+                    # title always precedes <redirect> in the dump.
+                    if redirect:
+                        break
+                elif tag == revision_tag:
+                    for child2 in child:
+                        tag = child2.tag
+                        if tag == text_tag:
+                            text = child2.text or ""
+                        elif tag == model_tag:
+                            # There are only a few distinct models, and
+                            # the model is kept for every page in
+                            # Wtp.page_seq, so share the strings.
+                            model = intern(child2.text or "")
+            if redirect:
+                yield "redirect", title, redirect
+            else:
+                yield model, title, text
+            # Drop the page (and anything before it) from the tree so
+            # that memory use stays bounded by the size of one page.
+            root.clear()
 
     return article_iter()
 
 
-def process_input(path, page_cb):
-    """Processes the entire input once, calling chunk_fn for each chunk.
-    A chunk is a list of data, where ``data`` is a dict
-    containing at least "title" and "text" keys.  This returns a list
-    of the values returned by ``chunk_fn`` in arbitrary order.  Each return
-    value must be json-serializable."""
+def open_dump(path):
+    """Opens the dump file ``path`` for reading.  Files ending in ".bz2"
+    or ".gz" are decompressed on the fly using the fastest method available
+    (see ``decompressors``).  Preferably this is a multi-threaded program
+    running in a separate process, to maximize concurrency; otherwise the
+    file may be decompressed in this process.  This returns (f, subp),
+    where ``f`` is a binary file object and ``subp`` is the decompressing
+    process or None.  The caller should close ``f`` and wait for ``subp``
+    when done."""
     assert isinstance(path, str)
-    assert callable(page_cb)
+    for ext, methods in decompressors.items():
+        if not path.endswith(ext):
+            continue
+        for method in methods:
+            if method is None:
+                continue
+            if callable(method):
+                # Decompress in a separate thread while parsing
+                return ThreadedReader(method(path)), None
+            prog = shutil.which(method[0])
+            if prog is None:
+                continue
+            # Report a missing file here; the program would only print
+            # an error and produce no output.
+            if not os.path.exists(path):
+                raise FileNotFoundError(errno.ENOENT,
+                                        os.strerror(errno.ENOENT), path)
+            subp = subprocess.Popen([prog] + list(method[1:]) + [path],
+                                    stdout=subprocess.PIPE,
+                                    bufsize=read_buffer_size)
+            return subp.stdout, subp
+    return open(path, "rb", buffering=read_buffer_size), None
+
+
+def decompress_error(subp, path):
+    """Returns an exception for the decompressing process ``subp`` having
+    failed on ``path``."""
+    return RuntimeError("{} failed with exit status {} on {}"
+                        .format(subp.args[0], subp.returncode, path))
+
+
+# Page callback of process_input() when calling it in parallel processes
+_global_page_cb = None
+
+
+def input_page_handler(dt):
+    """Helper function for calling the page callback of process_input() in
+    parallel processes.  This is a global function in order to make this
+    pickleable.  The implication is that process_input() is not
+    re-entrant when using multiple processes."""
+    model, title, text = dt
+    return _global_page_cb(model, title, text)
+
 
-    # Open the input file, optionally decompressing on the fly (in a parallel
-    # process to maximize concurrency).  This requires the ``buffer`` program.
-    subp = None
-    if path.endswith(".bz2"):
-        # cmd = "bzcat {} | buffer -m 16M".format(path)
-        cmd = "bzcat {}".format(path)
-        subp = subprocess.Popen(["/bin/sh", "-c", cmd], stdout=subprocess.PIPE,
-                                bufsize=256*1024)
-        wikt_f = subp.stdout
-    else:
-        wikt_f = open(path, "rb", buffering=(256 * 1024))
-
-    # Create an iterator that produces chunks of articles to process.
+def process_pages(path, page_cb, pool, chunksize):
+    """Helper function for process_input().  Parses ``path`` and calls
+    ``page_cb`` for each page, using ``pool`` (if not None) for calling it
+    in parallel processes.  Returns the values from ``page_cb`` that are
+    not None."""
+    # Open the input file, optionally decompressing on the fly.
+    wikt_f, subp = open_dump(path)
+
+    # Create an iterator that produces the pages to process.
     lst = []
-    for model, title, text in make_iter(wikt_f):
-        title = html.unescape(title)
-        text = html.unescape(text)
-        ret = page_cb(model, title, text)
-        if ret is not None:
-            lst.append(ret)
+    try:
+        pages = make_iter(wikt_f)
+        if pool is None:
+            for model, title, text in pages:
+                ret = page_cb(model, title, text)
+                if ret is not None:
+                    lst.append(ret)
+        else:
+            # The pool consumes the iterator in a separate thread, so
+            # parsing overlaps with collecting the results.
+            for ret in pool.imap_unordered(input_page_handler, pages,
+                                           chunksize=chunksize):
+                if ret is not None:
+                    lst.append(ret)
+    except ET.ParseError as e:
+        # A failing decompressor shows up as truncated XML.  If its output
+        # has not ended, the XML itself is broken; closing the pipe then
+        # makes the decompressor fail (e.g., with SIGPIPE), but that is
+        # not its fault.
+        if subp is not None and not wikt_f.read(1):
+            if subp.wait() != 0:
+                raise decompress_error(subp, path) from e
+        raise
+    finally:
+        wikt_f.close()
+        if subp is not None:
+            subp.wait()
 
+    if subp is not None and subp.returncode != 0:
+        raise decompress_error(subp, path)
     return lst
 
 
+def process_input(path, page_cb, num_threads=1, chunksize=64):
+    """Processes the entire input once, calling ``page_cb(model, title,
+    text)`` for each page.  This returns a list of the values returned by
+    ``page_cb``, except None values are ignored.  If ``num_threads`` is
+    not 1, ``page_cb`` is called in that many parallel processes (one per
+    CPU if None) using the multiprocessing package.  It then cannot save
+    data in global variables, its return values must be pickleable, and
+    the list will be in arbitrary order.  Pages are then sent to the
+    processes in batches of ``chunksize`` pages, to reduce the overhead
+    of passing each page separately.  The processes are started with
+    fork(); where that is not available (e.g., on Windows), ``page_cb``
+    is always called in this process."""
+    assert isinstance(path, str)
+    assert callable(page_cb)
+    assert num_threads is None or isinstance(num_threads, int)
+    assert isinstance(chunksize, int) and chunksize > 0
+    global _global_page_cb
+
+    # The page callback is passed to the processes in a global variable,
+    # which requires them to be forked.
+    if "fork" not in multiprocessing.get_all_start_methods():
+        num_threads = 1
+    if num_threads == 1:
+        return process_pages(path, page_cb, None, chunksize)
+
+    # Create the processes before opening the input, so that they are
+    # forked before any thread is started for reading the input.
+    _global_page_cb = page_cb
+    with multiprocessing.get_context("fork").Pool(num_threads) as pool:
+        return process_pages(path, page_cb, pool, chunksize)
+
+
 def process_dump(ctx, path, page_handler):
     """Parses a WikiMedia dump file ``path`` (which should point to a
     "<project>-<date>-pages-articles.xml.bz2" file.  This calls